@@ -2,16 +2,39 @@
 # saves its contents to a MongoDB database with versioning,
 # and provides a Flask API to retrieve the latest and historical configurations.
 
-# Required Libraries: pyyaml, pymongo, flask, watchdog
+# Required Libraries: pyyaml, pymongo, flask, watchdog, waitress, orjson
 # To install, run: pip install -r requirements.txt
 
 import yaml
-from datetime import datetime
-from flask import Flask, jsonify
-from pymongo import MongoClient
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+import sys
+try:
+    from yaml import CSafeLoader as SafeLoader  # libyaml-backed, much faster
+except ImportError:
+    from yaml import SafeLoader
+from datetime import datetime, timezone
+from flask import Flask, Response, jsonify, request
+from flask.json.provider import JSONProvider
+import orjson
+from waitress import serve
+from pymongo import MongoClient, DESCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+if sys.platform == 'win32':
+    # Native ReadDirectoryChangesW events, never the polling fallback
+    from watchdog.observers.read_directory_changes import WindowsApiObserver as Observer
+else:
+    from watchdog.observers import Observer
+from watchdog.events import PatternMatchingEventHandler
 import os
+import hashlib
+import glob
+import atexit
+from functools import lru_cache, partial
+import threading
+import queue
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 # ====================
 # Configuration
@@ -20,6 +43,17 @@ CONFIG_FILE = r'C:\auto_config_save\config.yaml'
 SECRETS_FILE = r'C:\auto_config_save\secrets.yaml'
 DB_NAME = 'config_db'
 COLLECTION_NAME = 'config_data'
+DEBOUNCE_SECONDS = 0.3
+BATCH_SIZE = 50
+BATCH_FLUSH_SECONDS = 0.5
+API_HOST = '127.0.0.1'
+API_PORT = 5000
+API_THREADS = 8
+LATEST_CACHE_TTL_SECONDS = 5
+
+# Fields returned by the API; everything else (e.g. _id) stays in MongoDB
+VERSION_PROJECTION = {"_id": 0, "version": 1, "timestamp": 1, "config": 1}
+VERSION_INDEX = [("version", -1)]
 
 # ====================
 # Load Secrets
@@ -31,7 +65,7 @@ def load_secrets(secret_file):
         raise FileNotFoundError(f"Secrets file not found: {abs_path}")
     try:
         with open(abs_path, 'r') as f:
-            secrets = yaml.safe_load(f)
+            secrets = yaml.load(f, Loader=SafeLoader)
         mongo_uri = secrets.get("mongo", {}).get("uri", "")
         if not mongo_uri:
             raise ValueError("MongoDB URI not found in secrets.yaml")
@@ -39,8 +73,67 @@ def load_secrets(secret_file):
     except Exception as e:
         raise RuntimeError(f"Error loading secrets: {e}")
 
-# Load MongoDB URI securely
-MONGO_URI = load_secrets(SECRETS_FILE)
+@lru_cache(maxsize=1)
+def mongo_uri():
+    """Load the MongoDB URI from the secrets file on first use"""
+    return load_secrets(SECRETS_FILE)
+
+# Shared MongoDB client (thread-safe, pools connections across requests), created on first use
+_client = None
+_collection = None
+_counters = None
+_mongo_lock = threading.Lock()
+
+def _create_version_index(collection):
+    """Create the unique version index, upgrading an earlier non-unique one once duplicates are gone"""
+    existing = collection.index_information().get("version_-1")
+    if existing and existing.get("unique"):
+        return
+    if existing:
+        # Same name with different options would be rejected, so replace the plain index
+        collection.drop_index("version_-1")
+    try:
+        collection.create_index(VERSION_INDEX, unique=True)
+    except DuplicateKeyError:
+        # Histories written before the version counter can repeat versions; keep working with a plain index
+        print("Warning: duplicate version numbers found in MongoDB. Using a non-unique version index; "
+              "remove the duplicates to enforce unique versions.")
+        collection.create_index(VERSION_INDEX)
+
+def _prepare_collections(collection, counters):
+    """Create indexes and seed the version counter"""
+    # Index versions so latest-version lookups are an index seek, not a collection scan
+    _create_version_index(collection)
+
+    # Seed the version counter from existing history so allocation never reuses a version
+    last_doc = collection.find_one({}, {"version": 1}, sort=[("version", DESCENDING)])
+    counters.update_one({"_id": "config"}, {"$max": {"seq": last_doc["version"] if last_doc else 0}}, upsert=True)
+
+def _connect():
+    """Connect to MongoDB once and prepare indexes and the version counter"""
+    global _client, _collection, _counters
+    with _mongo_lock:
+        if _client is None:
+            client = MongoClient(mongo_uri(), maxPoolSize=50, tz_aware=True)
+            collection = client[DB_NAME][COLLECTION_NAME]
+            counters = client[DB_NAME]["counters"]
+            try:
+                _prepare_collections(collection, counters)
+            except Exception:
+                # Don't leak this client's sockets and monitor threads; the next call retries
+                client.close()
+                raise
+            _client, _collection, _counters = client, collection, counters
+
+def _get_collection():
+    if _collection is None:
+        _connect()
+    return _collection
+
+def _get_counters():
+    if _counters is None:
+        _connect()
+    return _counters
 
 # ====================
 # Config Handling
@@ -49,7 +142,7 @@ def read_config(file_path):
     """Read YAML configuration file"""
     try:
         with open(file_path, 'r') as f:
-            data = yaml.safe_load(f)
+            data = yaml.load(f, Loader=SafeLoader)
         print('\nConfiguration File Parser Results:\n')
         return data
     except Exception as e:
@@ -57,51 +150,111 @@ def read_config(file_path):
         return None
 
 def convert_numeric_values(data):
-    """Recursively convert numeric strings to integers"""
-    if isinstance(data, dict):
-        for k, v in data.items():
-            if isinstance(v, dict):
-                convert_numeric_values(v)
-            elif isinstance(v, str) and v.isdigit():
-                data[k] = int(v)
+    """Convert numeric strings to integers in nested dicts and lists"""
+    if type(data) is not dict and type(data) is not list:
+        return data
+    stack = [data]
+    # YAML anchors can make containers shared or self-referential; visit each one once
+    seen = {id(data)}
+    while stack:
+        node = stack.pop()
+        items = node.items() if type(node) is dict else enumerate(node)
+        for k, v in items:
+            t = type(v)
+            if t is dict or t is list:
+                if id(v) not in seen:
+                    seen.add(id(v))
+                    stack.append(v)
+            elif t is str and v.isdigit():
+                node[k] = int(v)
     return data
 
 # ====================
 # MongoDB Handling
 # ====================
+def allocate_version(count=1):
+    """Atomically reserve the next `count` version numbers and return the last one"""
+    # One $inc per batch keeps versions gap-free and ordered across concurrent writers
+    counter = _get_counters().find_one_and_update(
+        {"_id": "config"},
+        {"$inc": {"seq": count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter["seq"]
+
 def save_to_mongo(data):
-    """Save configuration to MongoDB with versioning"""
-    try:
-        client = MongoClient(MONGO_URI)
-        db = client[DB_NAME]
-        collection = db[COLLECTION_NAME]
-
-        # Determine next version
-        last_doc = collection.find_one(sort=[("version", -1)])
-        next_version = 1 if not last_doc else last_doc['version'] + 1
-
-        doc = {
-            "version": next_version,
-            "timestamp": datetime.utcnow(),
-            "config": data
-        }
-        collection.insert_one(doc)
-        print(f"Configuration saved to MongoDB (version {next_version})")
-    except Exception as e:
-        print(f"Error saving to MongoDB: {e}")
+    """Queue configuration for a batched, versioned insert into MongoDB"""
+    _start_save_worker()
+    _save_queue.put({
+        "timestamp": datetime.now(timezone.utc),
+        "config": data
+    })
+
+def _next_batch():
+    """Wait for a queued config, then collect more until the batch is full or the flush window ends"""
+    batch = [_save_queue.get()]
+    deadline = time.monotonic() + BATCH_FLUSH_SECONDS
+    while len(batch) < BATCH_SIZE:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(_save_queue.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+def _insert_batch(docs):
+    """Insert queued configs with a contiguous block of versions"""
+    first_version = allocate_version(len(docs)) - len(docs) + 1
+    for i, doc in enumerate(docs):
+        doc["version"] = first_version + i
+    _get_collection().insert_many(docs, ordered=False)
+    for doc in docs:
+        print(f"Configuration saved to MongoDB (version {doc['version']})")
+    update_latest_cache(docs[-1])
+
+def _save_worker():
+    """Flush queued configs to MongoDB in batches"""
+    while True:
+        batch = _next_batch()
+        try:
+            _insert_batch(batch)
+        except Exception as e:
+            print(f"Error saving to MongoDB: {e}")
+        finally:
+            for _ in batch:
+                _save_queue.task_done()
+
+_save_queue = queue.Queue()
+_save_thread = None
+_save_thread_lock = threading.Lock()
+
+def _start_save_worker():
+    global _save_thread
+    with _save_thread_lock:
+        if _save_thread is None:
+            _save_thread = threading.Thread(target=_save_worker, daemon=True)
+            _save_thread.start()
+
+def _shutdown():
+    """Flush pending saves, then close the MongoDB connection"""
+    if _save_thread is not None:
+        _save_queue.join()
+    if _client is not None:
+        _client.close()
+
+atexit.register(_shutdown)
 
 def fetch_latest_from_mongo():
     """Fetch the latest configuration version"""
     try:
-        client = MongoClient(MONGO_URI)
-        db = client[DB_NAME]
-        collection = db[COLLECTION_NAME]
-
-        latest_doc = collection.find_one(sort=[("version", -1)])
+        latest_doc = _get_collection().find_one({}, VERSION_PROJECTION, sort=VERSION_INDEX)
         if latest_doc:
             return {
                 "version": latest_doc["version"],
-                "timestamp": latest_doc["timestamp"].isoformat(),
+                "timestamp": latest_doc["timestamp"],
                 "config": latest_doc["config"]
             }
         return {}
@@ -109,56 +262,213 @@ def fetch_latest_from_mongo():
         print(f"Error fetching from MongoDB: {e}")
         return {}
 
-def fetch_all_versions():
-    """Fetch all configuration versions"""
-    try:
-        client = MongoClient(MONGO_URI)
-        db = client[DB_NAME]
-        collection = db[COLLECTION_NAME]
-
-        docs = []
-        for doc in collection.find().sort("version", 1):
-            docs.append({
-                "version": doc["version"],
-                "timestamp": doc["timestamp"].isoformat(),
-                "config": doc["config"]
-            })
-        return docs
-    except Exception as e:
-        print(f"Error fetching from MongoDB: {e}")
-        return []
+# In-process cache of the latest version for /config, refreshed on insert or after the TTL
+_latest_cache = None
+_latest_expires = 0.0
+_latest_lock = threading.Lock()
+
+def update_latest_cache(doc):
+    """Cache doc as the latest version unless a newer one is already cached"""
+    global _latest_cache, _latest_expires
+    # Match what MongoDB returns, which stores datetimes at millisecond precision
+    timestamp = doc["timestamp"]
+    timestamp = timestamp.replace(microsecond=timestamp.microsecond // 1000 * 1000)
+    latest = {"version": doc["version"], "timestamp": timestamp, "config": doc["config"]}
+    with _latest_lock:
+        if _latest_cache and _latest_cache["version"] > latest["version"]:
+            return
+        _latest_cache = latest
+        _latest_expires = time.monotonic() + LATEST_CACHE_TTL_SECONDS
+
+def get_latest_cached():
+    """Return the latest version from the cache, falling back to MongoDB when stale"""
+    with _latest_lock:
+        if _latest_cache and time.monotonic() < _latest_expires:
+            return _latest_cache
+    latest = fetch_latest_from_mongo()
+    if latest:
+        update_latest_cache(latest)
+    return latest
+
+def iter_all_versions():
+    """Yield all configuration versions in order, fetching from MongoDB in batches"""
+    for doc in _get_collection().find({}, VERSION_PROJECTION).sort("version", 1).hint(VERSION_INDEX).batch_size(200):
+        yield {
+            "version": doc["version"],
+            "timestamp": doc["timestamp"],
+            "config": doc["config"]
+        }
 
 # ====================
 # Watchdog Event Handler
 # ====================
-class ConfigFileHandler(FileSystemEventHandler):
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+def get_parse_pool():
+    """Process pool for YAML parsing, created on first use"""
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            # One worker is enough for a debounced single-file parse. Spawn rather than fork,
+            # because forking after the server, watcher and Mongo threads start can deadlock the child
+            _parse_pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+            atexit.register(_parse_pool.shutdown)
+        return _parse_pool
+
+def discard_parse_pool(pool):
+    """Drop a pool whose worker died (e.g. out of memory) so the next parse gets a fresh one"""
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is pool:
+            _parse_pool = None
+    pool.shutdown(wait=False)
+
+class ConfigFileHandler(PatternMatchingEventHandler):
+    def __init__(self):
+        # Let watchdog drop events for other files in the directory before dispatch;
+        # escape the path so characters like [ ] in it aren't treated as glob syntax
+        super().__init__(patterns=[glob.escape(os.path.abspath(CONFIG_FILE))], ignore_directories=True, case_sensitive=False)
+        self._timer = None
+        self._lock = threading.Lock()
+        self._last_stat = None
+        self._last_digest = None
+        self._pending = None
+
     def on_modified(self, event):
-        if os.path.abspath(event.src_path) == os.path.abspath(CONFIG_FILE):
-            print(f"\nDetected changes in {CONFIG_FILE}. Updating MongoDB...")
-            data = read_config(CONFIG_FILE)
-            if data:
-                data = convert_numeric_values(data)
-                save_to_mongo(data)
+        # Editors emit several events per save; only process once they settle
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+            self._timer = threading.Timer(DEBOUNCE_SECONDS, self._process)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _unchanged(self):
+        """Return True if the config file content is the same as last processed"""
+        try:
+            st = os.stat(CONFIG_FILE)
+        except OSError:
+            return False
+        stat_key = (st.st_mtime_ns, st.st_size)
+        if stat_key == self._last_stat:
+            return True
+
+        # mtime also changes on a plain touch, so confirm with a content hash
+        try:
+            with open(CONFIG_FILE, 'rb') as f:
+                digest = hashlib.blake2b(f.read()).digest()
+        except OSError:
+            # e.g. an editor still holds the file locked; let the parse step retry and report
+            return False
+        self._last_stat = stat_key
+        if digest == self._last_digest:
+            return True
+        self._last_digest = digest
+        return False
+
+    def _process(self):
+        if self._unchanged():
+            return
+        print(f"\nDetected changes in {CONFIG_FILE}. Updating MongoDB...")
+        # Parse in a worker process so large files don't block this process
+        pool = get_parse_pool()
+        try:
+            future = pool.submit(read_config, CONFIG_FILE)
+        except BrokenProcessPool:
+            # The worker died after an earlier parse; retry once on a fresh pool
+            discard_parse_pool(pool)
+            pool = get_parse_pool()
+            future = pool.submit(read_config, CONFIG_FILE)
+        self._pending = future
+        future.add_done_callback(partial(self._on_parsed, pool))
+
+    def _on_parsed(self, pool, future):
+        # A newer change was submitted meanwhile; only its result should be saved
+        if future is not self._pending:
+            return
+        try:
+            data = future.result()
+        except BrokenProcessPool as e:
+            print(f"Error reading YAML file: parser process died ({e})")
+            discard_parse_pool(pool)
+            # Forget the file state so the next event for this content is parsed again
+            self._last_stat = None
+            self._last_digest = None
+            return
+        except Exception as e:
+            print(f"Error reading YAML file: {e}")
+            return
+        if data:
+            data = convert_numeric_values(data)
+            save_to_mongo(data)
 
 # ====================
 # Flask API
 # ====================
+class OrjsonProvider(JSONProvider):
+    """Serialize JSON with orjson; datetimes are emitted as ISO 8601"""
+    option = orjson.OPT_SORT_KEYS | orjson.OPT_NAIVE_UTC
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=self.option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+def stream_json_array(first, rest):
+    """Encode first followed by the items of rest as a JSON array, one element at a time"""
+    yield '['
+    try:
+        yield app.json.dumps(first)
+        for item in rest:
+            yield ','
+            yield app.json.dumps(item)
+    except Exception as e:
+        # Leave the array unclosed so the client sees invalid JSON, not a silently truncated history
+        print(f"Error streaming config history: {e}")
+        return
+    yield ']'
+
+def stream_all_versions():
+    """Stream all versions as a JSON array; errors on the first batch become a 500"""
+    versions = iter_all_versions()
+    try:
+        first = next(versions, None)
+    except Exception as e:
+        print(f"Error fetching from MongoDB: {e}")
+        return jsonify({"error": "Error fetching from MongoDB"}), 500
+    if first is None:
+        return jsonify([])
+    return Response(stream_json_array(first, versions), mimetype='application/json')
 
 @app.route('/config', methods=['GET'])
 def get_latest_config():
-    data = fetch_latest_from_mongo()
-    return jsonify(data)
+    data = get_latest_cached()
+    response = jsonify(data)
+    if data:
+        # Versions are immutable, so the version number identifies the content
+        response.set_etag(str(data["version"]))
+    return response.make_conditional(request)
 
 @app.route('/config/history', methods=['GET'])
 def get_config_history():
-    data = fetch_all_versions()
-    return jsonify(data)
+    return stream_all_versions()
 
 # ====================
 # Main Execution
 # ====================
 if __name__ == "__main__":
+    # Fail fast on missing secrets; the connection itself is opened on first use
+    mongo_uri()
+
+    # Record the file's current state so a later no-op touch isn't saved again
+    event_handler = ConfigFileHandler()
+    event_handler._unchanged()
+
     # Initial load
     data = read_config(CONFIG_FILE)
     if data:
@@ -172,14 +482,14 @@ if __name__ == "__main__":
                 print(f"- {k}: {v}")
 
     # Watchdog to auto-update
-    event_handler = ConfigFileHandler()
     observer = Observer()
+    observer.daemon = True
     observer.schedule(event_handler, path=os.path.dirname(os.path.abspath(CONFIG_FILE)) or '.', recursive=False)
     observer.start()
     print(f"\nWatching {CONFIG_FILE} for changes...")
 
     try:
-        app.run(debug=True, use_reloader=False)
+        serve(app, host=API_HOST, port=API_PORT, threads=API_THREADS)
     except KeyboardInterrupt:
         observer.stop()
     observer.join()